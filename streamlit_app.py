@@ -3,13 +3,20 @@ import json
 import requests
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import textwrap
 import os
+import re
+import secrets
 import urllib.request
 import json as _json
-from collections import Counter, defaultdict
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from datetime import timedelta
 
@@ -115,6 +122,21 @@ GAS_WEBAPP_URL = st.secrets.get("gas", {}).get("webapp_url", "").strip()
 TEACHER_KEY    = st.secrets.get("app", {}).get("teacher_key", "").strip()
 TIMEOUT        = 25
 
+# Shared cache: ไฟล์ SQLite บนดิสก์เครื่องเดียวกัน ใช้ร่วมกันทุก replica (ตั้ง [cache].path ใน Secrets ได้)
+# ไฟล์นี้มีเฉลย (answer_key) และคำตอบที่ autosave ไว้ — เก็บในโฟลเดอร์ของแอป สิทธิ์ 0600 เท่านั้น
+CACHE_PATH     = (st.secrets.get("cache", {}).get("path", "") or "").strip() \
+                 or os.path.join(os.path.expanduser("~"), ".cache", "mcq_answer_sheet", "shared_cache.sqlite3")
+CACHE_POOL_SIZE = 4    # จำนวน connection ที่เก็บไว้ใช้ซ้ำต่อ process
+CACHE_L1_SIZE  = 256   # จำนวน entry สูงสุดใน LRU ของแต่ละ process
+TTL_ACTIVE_EXAM = 15   # วินาที
+TTL_QUESTIONS   = 600
+TTL_CONFIG      = 30
+TTL_DASHBOARD   = 20
+SEED_RETRY_SECONDS = 60           # seed ดัชนีส่งซ้ำล้มเหลว → รอก่อนลองใหม่
+INDEX_MAX_AGE      = 3 * TTL_DASHBOARD  # ดัชนีส่งซ้ำที่ไม่ได้ seed ใหม่นานกว่านี้จะไม่ถูกใช้ตัดสิน
+AUTOSAVE_DELAY     = 3            # วินาที — รวบการคลิกหลายครั้งเป็นการเขียนครั้งเดียว
+AUTOSAVE_RETENTION = 24 * 3600    # ลบ checkpoint ที่ไม่ได้แตะเกิน 1 วัน
+
 # ---------------- GAS Helpers ----------------
 def gas_get(action: str, params: dict | None = None):
     if not GAS_WEBAPP_URL:
@@ -154,6 +176,159 @@ def gas_post(action: str, payload: dict):
     except Exception:
         raise RuntimeError(f"GAS ตอบกลับไม่ใช่ JSON ({ct}) — ตัวอย่าง: {body_preview}")
 
+# ---------------- Shared Cache (SQLite-WAL + in-process LRU) ----------------
+CACHE_ERRORS = (sqlite3.Error, OSError)
+
+def prepare_private_file(path: str):
+    """สร้างไฟล์ (และโฟลเดอร์) ให้เจ้าของแอปอ่าน/เขียนได้คนเดียว ก่อนให้ SQLite เปิดใช้"""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    os.close(fd)
+    os.chmod(path, 0o600)  # ไฟล์ -wal/-shm ที่ SQLite สร้างทีหลังจะได้สิทธิ์เดียวกับไฟล์หลัก
+
+class SQLitePool:
+    """Small lock-guarded pool of autocommit connections to one SQLite (WAL) file.
+
+    Streamlit starts a new script thread for almost every rerun, so connections are
+    checked out per operation rather than pinned to a thread. A connection that raised
+    is closed (rolling back any open transaction) instead of going back to the pool.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        prepare_private_file(path)
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+@st.cache_resource
+def get_sqlite_pool() -> SQLitePool:
+    return SQLitePool(CACHE_PATH, CACHE_POOL_SIZE)
+
+class SharedCache:
+    """Two-tier cache: an in-process LRU in front of a SQLite (WAL) file shared by all replicas.
+
+    Every entry is stamped with a global generation number stored in the same file.
+    invalidate_all() bumps it, so stale entries are ignored by every replica on its next get().
+    Values are JSON-serializable GAS responses and must be treated as read-only.
+    """
+
+    def __init__(self, pool: SQLitePool, l1_size: int):
+        self.pool = pool
+        self.l1_size = l1_size
+        self._l1 = OrderedDict()  # key -> (expires_at, generation, value)
+        self._lock = threading.Lock()
+        with self.pool.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, generation INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0)")
+
+    def generation(self) -> int:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _l1_put(self, key: str, expires_at: float, generation: int, value):
+        with self._lock:
+            self._l1[key] = (expires_at, generation, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+
+    def get(self, key: str, generation: int):
+        now = time.time()
+        with self._lock:
+            hit = self._l1.get(key)
+            if hit is not None:
+                expires_at, gen, value = hit
+                if gen == generation and expires_at > now:
+                    self._l1.move_to_end(key)
+                    return value
+                del self._l1[key]
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at, generation FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[2] != generation or row[1] <= now:
+            return None
+        value = json.loads(row[0])
+        self._l1_put(key, row[1], generation, value)
+        return value
+
+    def set(self, key: str, value, ttl: float, generation: int):
+        # generation ต้องอ่านไว้ "ก่อน" fetch ข้อมูล เพื่อไม่ให้ค่าที่ดึงมาก่อน invalidate ถูกนับว่าใหม่
+        expires_at = time.time() + ttl
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, generation) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, generation),
+            )
+        self._l1_put(key, expires_at, generation, value)
+
+    def invalidate_all(self):
+        with self.pool.connection() as conn:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            conn.execute("DELETE FROM cache")
+        with self._lock:
+            self._l1.clear()
+
+@st.cache_resource
+def get_shared_cache() -> SharedCache:
+    return SharedCache(get_sqlite_pool(), CACHE_L1_SIZE)
+
+def gas_get_cached(action: str, params: dict | None = None, ttl: float = TTL_CONFIG):
+    """gas_get ผ่าน shared cache — เก็บเฉพาะคำตอบที่ ok เท่านั้น; ถ้า cache ใช้ไม่ได้จะเรียก GAS ตรง"""
+    key = f"{action}:{json.dumps(params or {}, sort_keys=True, ensure_ascii=False)}"
+    try:
+        cache = get_shared_cache()
+        generation = cache.generation()
+        hit = cache.get(key, generation)
+    except CACHE_ERRORS:
+        return gas_get(action, params)
+    if hit is not None:
+        return hit
+    js = gas_get(action, params)
+    if js.get("ok"):
+        try:
+            cache.set(key, js, ttl, generation)
+        except CACHE_ERRORS:
+            pass
+    return js
+
+def invalidate_shared_cache():
+    try:
+        get_shared_cache().invalidate_all()
+    except CACHE_ERRORS:
+        pass
+
 # ---------------- Routing (via ?mode=...) ----------------
 raw_mode = st.query_params.get("mode", "exam")
 if isinstance(raw_mode, list) and raw_mode:
@@ -181,6 +356,368 @@ def is_within_window(start_utc: str, end_utc: str) -> tuple[bool, str]:
         # ถ้าพาร์สเวลาไม่ได้ ให้ปล่อยผ่าน (ไม่ล็อก) เพื่อไม่บล็อคผู้ใช้โดยผิดพลาด
         return True, f"ไม่สามารถตรวจสอบเวลาได้ ({e})"
 
+# ---------------- Duplicate-submission Index ----------------
+def normalize_student_key(name: str) -> str:
+    """ชื่อสำหรับเทียบซ้ำ: ตัดช่องว่างหัวท้ายเท่านั้น — ต้องตรงกับที่ backend ใช้ตรวจ DUPLICATE_SUBMISSION
+    (ห้ามหลวมกว่า backend ไม่งั้นจะปฏิเสธชื่อที่ backend ยอมรับ)"""
+    return str(name or "").strip()
+
+class SubmissionIndex:
+    """Per-exam set of names that already submitted, shared by every session in this process.
+
+    Seeded from get_dashboard on a background thread and re-seeded once the set is older
+    than TTL_DASHBOARD; a re-seed replaces the exam's set, so rows a teacher deletes (to
+    allow a retake) drop out. Seeding never blocks a submit: until a fresh set exists, a
+    lookup misses and the submit goes to gas_post, which stays authoritative. A set older
+    than INDEX_MAX_AGE (e.g. re-seed keeps failing) is not trusted. Failed seeds retry
+    after SEED_RETRY_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # ถือสั้น ๆ เท่านั้น — ไม่เคยถือข้าม network call
+        self._by_exam: dict[str, set[str]] = {}
+        self._seeded_at: dict[str, float] = {}  # exam -> เวลาที่ seed สำเร็จครั้งล่าสุด
+        self._seeding: set[str] = set()         # exam ที่มี thread กำลัง seed อยู่ (กันยิงซ้ำต่อชุด)
+        self._retry_at: dict[str, float] = {}   # exam ที่ seed ล้มเหลว -> เวลาที่ลองใหม่ได้
+        self._generation = None  # generation ของ shared cache ตอน seed — เปลี่ยนเมื่อมีการ set_active_exam
+
+    def _sync_generation(self):
+        try:
+            generation = get_shared_cache().generation()
+        except CACHE_ERRORS:
+            return
+        with self._lock:
+            if generation != self._generation:
+                self._by_exam.clear()
+                self._seeded_at.clear()
+                self._retry_at.clear()
+                self._generation = generation
+
+    def ensure_seeded(self, exam_id: str):
+        """เริ่ม seed (หรือ seed ใหม่เมื่อข้อมูลเก่าเกิน TTL_DASHBOARD) ใน background — คืนค่าทันทีเสมอ"""
+        self._sync_generation()
+        now = time.time()
+        with self._lock:
+            if (exam_id in self._seeding
+                    or now - self._seeded_at.get(exam_id, float("-inf")) < TTL_DASHBOARD
+                    or self._retry_at.get(exam_id, 0) > now):
+                return
+            self._seeding.add(exam_id)
+            generation = self._generation
+        thread = threading.Thread(target=self._seed, args=(exam_id, generation), daemon=True)
+        add_script_run_ctx(thread)  # ให้ cache_resource/secrets ใช้งานได้ใน thread นี้
+        thread.start()
+
+    def _seed(self, exam_id: str, generation):
+        names = None
+        try:
+            js = gas_get_cached("get_dashboard", {"exam_id": exam_id}, ttl=TTL_DASHBOARD)
+            if js.get("ok"):
+                names = {normalize_student_key(r.get("student_name")) for r in (js.get("data") or [])}
+                names.discard("")
+        except Exception:
+            pass  # seed ไม่ได้ก็ไม่เป็นไร ให้ backend ตรวจซ้ำตามเดิม แล้วค่อยลองใหม่
+        with self._lock:
+            self._seeding.discard(exam_id)
+            if generation != self._generation:
+                return  # ถูก reset ระหว่าง seed — ข้อมูลนี้อาจเก่าแล้ว
+            if names is None:
+                self._retry_at[exam_id] = time.time() + SEED_RETRY_SECONDS
+                return
+            self._by_exam[exam_id] = names  # แทนที่ทั้งชุด ไม่ merge — แถวที่ถูกลบต้องหายไปด้วย
+            self._seeded_at[exam_id] = time.time()
+            self._retry_at.pop(exam_id, None)
+
+    def contains(self, exam_id: str, name: str) -> bool:
+        with self._lock:
+            if time.time() - self._seeded_at.get(exam_id, float("-inf")) > INDEX_MAX_AGE:
+                return False  # ดัชนีเก่าเกินไป — ให้ backend ตัดสิน
+            return normalize_student_key(name) in self._by_exam.get(exam_id, ())
+
+    def add(self, exam_id: str, name: str):
+        key = normalize_student_key(name)
+        if not key:
+            return
+        with self._lock:
+            self._by_exam.setdefault(exam_id, set()).add(key)
+
+@st.cache_resource
+def get_submission_index() -> SubmissionIndex:
+    return SubmissionIndex()
+
+# ---------------- Answer Autosave (debounced checkpoints) ----------------
+RESUME_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{32,64}")
+
+class AnswerCheckpoints:
+    """Debounced, coalesced autosave of in-progress answer sheets, keyed by (exam_id, resume token).
+
+    The token is a random per-session value kept in ?resume=. A URL can be forwarded, so the
+    token alone is not proof of ownership: claim() hands a checkpoint over only when the
+    retyped name matches the saved one, and deletes it so the same link cannot be restored
+    twice. save() only updates an
+    in-memory pending map; a single timer flushes all pending sheets from every session in
+    one transaction at most once per `delay` seconds. Checkpoints live in the shared cache
+    file (same SQLitePool as SharedCache) so any replica can restore them.
+    """
+
+    def __init__(self, pool: SQLitePool, delay: float, retention: float):
+        self.pool = pool
+        self.delay = delay
+        self.retention = retention
+        self._lock = threading.Lock()        # ป้องกัน _pending/_flushing/_timer
+        self._write_lock = threading.Lock()  # ให้ flush/discard เขียนลงไฟล์ทีละอัน
+        self._pending: dict[tuple[str, str], dict] = {}
+        self._flushing: dict[tuple[str, str], dict] = {}  # ชุดที่กำลังเขียน — load() ยังต้องเห็นจนกว่าจะ commit
+        self._timer = None
+        with self.pool.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS autosave ("
+                "exam_id TEXT NOT NULL, token TEXT NOT NULL, sheet TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (exam_id, token))"
+            )
+
+    def save(self, exam_id: str, token: str, sheet: dict):
+        with self._lock:
+            self._pending[(exam_id, token)] = dict(sheet)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+                self._timer = None
+                batch = self._flushing
+            if not batch:
+                return
+            now = time.time()
+            rows = [(e, t, json.dumps(v, ensure_ascii=False), now) for (e, t), v in batch.items()]
+            try:
+                with self.pool.connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO autosave (exam_id, token, sheet, updated_at) VALUES (?, ?, ?, ?)",
+                        rows,
+                    )
+                    conn.execute("DELETE FROM autosave WHERE updated_at < ?", (now - self.retention,))
+                    conn.execute("COMMIT")
+            except CACHE_ERRORS:
+                pass  # autosave เป็นแค่ตัวช่วย — เขียนไม่ได้ก็ไม่ควรทำให้หน้าสอบพัง
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def load(self, exam_id: str, token: str) -> dict | None:
+        key = (exam_id, token)
+        with self._lock:
+            for batch in (self._pending, self._flushing):
+                if key in batch:
+                    return dict(batch[key])
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute(
+                    "SELECT sheet FROM autosave WHERE exam_id = ? AND token = ?", key
+                ).fetchone()
+        except CACHE_ERRORS:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def claim(self, exam_id: str, token: str, student_name: str) -> dict | None:
+        """คืน checkpoint และลบทิ้งในคราวเดียว — เฉพาะเมื่อชื่อตรงกับที่บันทึกไว้ (ชื่อผิดจะไม่แตะ checkpoint)"""
+        key = (exam_id, token)
+        with self._write_lock:  # flush ไม่ได้ทำงานอยู่ → _flushing ว่าง
+            with self._lock:
+                sheet = self._pending.get(key)
+            in_memory = sheet is not None
+            try:
+                with self.pool.connection() as conn:
+                    if not in_memory:
+                        row = conn.execute(
+                            "SELECT sheet FROM autosave WHERE exam_id = ? AND token = ?", key
+                        ).fetchone()
+                        sheet = json.loads(row[0]) if row else None
+                    if not sheet or str(sheet.get("student_name", "")).strip() != student_name.strip():
+                        return None
+                    with self._lock:
+                        self._pending.pop(key, None)
+                    cur = conn.execute("DELETE FROM autosave WHERE exam_id = ? AND token = ?", key)
+            except CACHE_ERRORS:
+                return None
+            if not in_memory and cur.rowcount == 0:
+                return None  # replica อื่น claim ไปก่อนแล้ว
+        return dict(sheet)
+
+    def discard(self, exam_id: str, token: str):
+        key = (exam_id, token)
+        with self._write_lock:
+            with self._lock:
+                self._pending.pop(key, None)
+            try:
+                with self.pool.connection() as conn:
+                    conn.execute("DELETE FROM autosave WHERE exam_id = ? AND token = ?", key)
+            except CACHE_ERRORS:
+                pass
+
+@st.cache_resource
+def get_answer_checkpoints() -> AnswerCheckpoints:
+    return AnswerCheckpoints(get_sqlite_pool(), AUTOSAVE_DELAY, AUTOSAVE_RETENTION)
+
+def get_answer_checkpoints_or_none() -> AnswerCheckpoints | None:
+    try:
+        return get_answer_checkpoints()
+    except CACHE_ERRORS:
+        return None  # ไฟล์ cache ใช้ไม่ได้ — สอบต่อได้ แค่ไม่มี autosave
+
+def discard_checkpoint(exam_id: str, token: str):
+    checkpoints = get_answer_checkpoints_or_none()
+    if checkpoints is not None:
+        checkpoints.discard(exam_id, token)
+
+def sync_resume_param():
+    """?resume= ชี้ token เดิมของ link จนกว่าจะ claim สำเร็จหรือ session นี้เริ่มบันทึกเอง
+    (เน็ตหลุดซ้ำก่อนพิมพ์ชื่อก็ยังกู้ได้) จากนั้นชี้ token ของ session นี้"""
+    ss = st.session_state
+    pending_claim = ss.get("resume_claim") and ss.get("last_checkpoint") is None
+    token = ss["resume_claim"] if pending_claim else ss["resume_token"]
+    if st.query_params.get("resume") != token:
+        st.query_params["resume"] = token
+
+def claim_checkpoint(exam_id: str, qn: int, name: str):
+    """กู้คำตอบจาก token ของ link (ไม่ต้องเรียก GAS) — ต้องพิมพ์ชื่อตรงกับที่บันทึกไว้ และกระดาษยังว่าง"""
+    ss = st.session_state
+    name = name.strip()
+    if not ss.get("resume_claim") or not name or any(ss["answers"]) or ss.get("resume_tried_name") == name:
+        return
+    ss["resume_tried_name"] = name  # ลองครั้งเดียวต่อชื่อที่พิมพ์ ไม่อ่านไฟล์ซ้ำทุก rerun
+    checkpoints = get_answer_checkpoints_or_none()
+    if checkpoints is None:
+        return
+    saved = checkpoints.claim(exam_id, ss["resume_claim"], name)
+    if not saved or len(saved.get("answers") or []) != qn:
+        return
+    ss["resume_claim"] = None
+    ss["answers"] = list(saved["answers"])
+    ss["last_checkpoint"] = None  # ให้ autosave ย้ายคำตอบไปไว้ใต้ token ของ session นี้ทันที
+    for i in range(qn):
+        ss.pop(f"q_{i+1}_radio", None)  # ให้ radio ใช้ index จากคำตอบที่กู้มา
+    st.toast(f"กู้คืนคำตอบที่บันทึกไว้ {sum(1 for x in saved['answers'] if x)} ข้อ")
+
+@st.fragment
+def render_answer_sheet(exam_id: str, qn: int, questions_dict: dict, disabled_all: bool):
+    """กระดาษคำตอบ — เป็น fragment: คลิกตัวเลือกจะ rerun เฉพาะส่วนนี้ ไม่ใช่ทั้งหน้า"""
+    ss = st.session_state
+    name = st.text_input("ชื่อผู้สอบ", placeholder="พิมพ์ชื่อ-สกุล", disabled=disabled_all, key="student_name")
+    if not disabled_all:
+        claim_checkpoint(exam_id, qn, name)
+
+    # --------------------- ⭐️ START MODIFIED LOOP (Dynamic Choices) ---------------------
+
+    # ค่าตัวเลือกที่เราจะใช้เป็น "Key" (ยังคงเป็น A, B, C...)
+    radio_value_keys = ["A", "B", "C", "D", "E"]
+
+    for i in range(qn):
+        q_num = i + 1 # เลขข้อ (1-based)
+        question = questions_dict.get(q_num)
+
+        # 3.1) แสดงโจทย์คำถาม
+        with st.container(border=True): 
+            st.markdown(f"**คำถามข้อที่ {q_num}**")
+
+            if question:
+                # --------------------- ⭐️ START FIX (Line Breaks) ---------------------
+                if question.get("text"):
+                    # เปลี่ยน \n (new line) ธรรมดาให้เป็น Markdown hard break (two-spaces + \n)
+                    # เพื่อให้ st.markdown แสดงผลการขึ้นบรรทัดใหม่
+                    q_text = question.get("text").replace("\n", "  \n")
+                    st.markdown(q_text) # 👈 ใช้ตัวแปรที่ผ่านการ replace แล้ว
+                # --------------------- ⭐️ END FIX (Line Breaks) ---------------------
+
+                if question.get("img_url"):
+                    st.image(question.get("img_url")) # แสดงรูป
+            else:
+                st.caption("...(ไม่มีข้อมูลโจทย์)...") # กรณีดึงโจทย์ข้อนี้ไม่สำเร็จ
+
+        # 3.2) สร้างตัวเลือก (st.radio) แบบไดนามิก
+
+        # สร้าง "ตัวเลือก" ที่จะแสดงผล
+        # (เราจะใช้ format_func เพื่อสร้างข้อความที่แสดง)
+        radio_options_values = [""] + radio_value_keys # ["", "A", "B", "C", "D", "E"]
+
+        # สร้าง Dictionary สำหรับ map ค่า (A) ไปเป็นข้อความ (Choice A Text)
+        # ถ้าไม่มีข้อมูล question ให้ใช้ค่าว่าง
+        choice_map = {
+            "A": question.get("choice_a", "") if question else "",
+            "B": question.get("choice_b", "") if question else "",
+            "C": question.get("choice_c", "") if question else "",
+            "D": question.get("choice_d", "") if question else "",
+            "E": question.get("choice_e", "") if question else "",
+        }
+
+        # สร้างฟังก์ชันสำหรับจัดรูปแบบการแสดงผล
+        def format_radio_option(value_key):
+            if value_key == "":
+                return " (เว้นว่าง) "
+
+            # ดึงข้อความของตัวเลือกจาก choice_map
+            choice_text = choice_map.get(value_key)
+
+            if choice_text:
+                # ถ้ามีข้อความ: แสดง "A. [ข้อความตัวเลือก]"
+                # --------------------- ⭐️ START FIX (Line Breaks in Choices) ---------------------
+                # เรา replace \n ด้วย " " (เว้นวรรค) ในตัวเลือก
+                # เพราะ st.radio "ไม่รองรับ" การขึ้นบรรทัดใหม่ใน Label
+                choice_text_single_line = choice_text.replace("\n", " ")
+                return f" {value_key}. {choice_text_single_line} "
+                # --------------------- ⭐️ END FIX (Line Breaks in Choices) ---------------------
+            else:
+                # ถ้าไม่มีข้อความ (อาจารย์ไม่ได้กรอก): แสดง "A"
+                return f" {value_key} "
+
+        current = ss["answers"][i]
+        choice = st.radio(
+            f"**คำตอบ** ข้อ {q_num}",
+            options=radio_options_values,   # ค่าที่จะถูกเก็บ: ["", "A", "B", ...]
+            format_func=format_radio_option, # ฟังก์ชันที่เปลี่ยนค่าเป็นข้อความ
+            index=radio_options_values.index(current) if current in radio_options_values else 0,
+            horizontal=True,
+            disabled=disabled_all,
+            key=f"q_{i+1}_radio",
+        )
+        ss["answers"][i] = choice
+        st.divider()
+    # --------------------- ⭐️ END MODIFIED LOOP ---------------------
+
+    submitted_form = st.button(
+        "ส่งคำตอบ",
+        type="primary",
+        use_container_width=True,
+        disabled=disabled_all,
+    )
+
+    # 3.3) autosave — บันทึกเฉพาะเมื่อมีชื่อและคำตอบเปลี่ยน (การเขียนจริงถูก debounce ใน AnswerCheckpoints)
+    # เขียนใต้ token ของ session นี้เสมอ ไม่เคยเขียนทับ checkpoint ของ link ที่ได้มา
+    checkpoints = get_answer_checkpoints_or_none()
+    if checkpoints is not None and not disabled_all and name.strip():
+        snapshot = {"student_name": name, "answers": list(ss["answers"])}
+        if ss["last_checkpoint"] != snapshot:
+            checkpoints.save(exam_id, ss["resume_token"], snapshot)
+            ss["last_checkpoint"] = snapshot
+    sync_resume_param()
+
+    if submitted_form and not ss["submitted"]:
+        if not name.strip():
+            ss["submit_error"] = "กรุณากรอกชื่อ"
+        else:
+            ss["submit_error"] = None
+            ss["pending_submit_payload"] = {
+                "exam_id": exam_id,
+                "student_name": name.strip(),
+                "answers": ss["answers"],
+            }
+        st.rerun()  # rerun ทั้งหน้า เพื่อส่งคำตอบ/แสดงข้อผิดพลาดนอก fragment
+
 def page_exam():
     load_css()
     st.markdown("### 📝 กระดาษคำตอบ MCQ Resident ER-Rajavithi")
@@ -190,7 +727,7 @@ def page_exam():
 
     # 1) โหลดชุดข้อสอบ
     try:
-        js = gas_get("get_active_exam")
+        js = gas_get_cached("get_active_exam", ttl=TTL_ACTIVE_EXAM)
         if not js.get("ok"):
             # --------------------- START FIX/DEBUGGING ---------------------
             st.error("ยังไม่ได้กำหนดชุดข้อสอบที่ใช้อยู่ (Active Exam) หรือรูปแบบ JSON ไม่ถูกต้อง")
@@ -211,6 +748,7 @@ def page_exam():
 
     qn = int(exam.get("question_count", 0))
     exam_id = exam.get("exam_id", "")
+    get_submission_index().ensure_seeded(exam_id)  # เริ่ม seed ใน background ตั้งแต่เปิดหน้า
     st.info(f"ชุด: **{exam_id}** • {exam.get('title','')} • จำนวน **{qn}** ข้อ (ตัวเลือก A–E)") # เน้นตัวหนา
 
     # --------------------- ⭐️ START NEW CODE (Get Questions) ---------------------
@@ -224,7 +762,7 @@ def page_exam():
         try:
             # ใช้ st.spinner เพื่อความสวยงาม
             with st.spinner(f"กำลังโหลดโจทย์คำถาม ชุด {exam_id}..."):
-                q_js = gas_get("get_questions", {"exam_id": exam_id})
+                q_js = gas_get_cached("get_questions", {"exam_id": exam_id}, ttl=TTL_QUESTIONS)
             
             if q_js.get("ok"):
                 # แปลง list of objects เป็น dict เพื่อง่ายต่อการค้นหา
@@ -295,6 +833,16 @@ def page_exam():
     ss.setdefault("submit_result", None)
     ss.setdefault("submit_error", None)
     ss.setdefault("answers", [""] * qn)
+    ss.setdefault("last_checkpoint", None)
+    ss.setdefault("student_name", "")  # ไม่เติมชื่อจาก checkpoint ให้เด็ดขาด — ต้องพิมพ์เอง
+    # token ใน URL (?resume=...) ที่ติดมากับ link ถือเป็นแค่ "สิทธิ์ขอกู้" (resume_claim) ไม่ใช่ของ session นี้
+    # session นี้ได้ token ใหม่ของตัวเองเสมอ — link ที่ถูกส่งต่อจึงเขียนทับ/กู้ซ้ำไม่ได้
+    if "resume_token" not in ss:
+        url_token = str(st.query_params.get("resume", "") or "")
+        ss["resume_claim"] = url_token if RESUME_TOKEN_RE.fullmatch(url_token) else None
+        ss["resume_tried_name"] = None
+        ss["resume_token"] = secrets.token_urlsafe(24)
+    sync_resume_param()
 
     if ss["submit_result"] is not None:
         ss["submitted"] = True
@@ -302,117 +850,34 @@ def page_exam():
     is_pending = ss["pending_submit_payload"] is not None
     disabled_all = ss["submitted"] or is_pending
 
-    with st.form("exam_form", clear_on_submit=False):
-        name = st.text_input("ชื่อผู้สอบ", placeholder="พิมพ์ชื่อ-สกุล", disabled=disabled_all)
-
-        if len(ss["answers"]) != qn:
-            ss["answers"] = [""] * qn
-
-        # --------------------- ⭐️ START MODIFIED LOOP (Dynamic Choices) ---------------------
-        
-        # ค่าตัวเลือกที่เราจะใช้เป็น "Key" (ยังคงเป็น A, B, C...)
-        radio_value_keys = ["A", "B", "C", "D", "E"]
-
-        for i in range(qn):
-            q_num = i + 1 # เลขข้อ (1-based)
-            question = questions_dict.get(q_num)
-
-            # 3.1) แสดงโจทย์คำถาม
-            with st.container(border=True): 
-                st.markdown(f"**คำถามข้อที่ {q_num}**")
-                
-                if question:
-                    # --------------------- ⭐️ START FIX (Line Breaks) ---------------------
-                    if question.get("text"):
-                        # เปลี่ยน \n (new line) ธรรมดาให้เป็น Markdown hard break (two-spaces + \n)
-                        # เพื่อให้ st.markdown แสดงผลการขึ้นบรรทัดใหม่
-                        q_text = question.get("text").replace("\n", "  \n")
-                        st.markdown(q_text) # 👈 ใช้ตัวแปรที่ผ่านการ replace แล้ว
-                    # --------------------- ⭐️ END FIX (Line Breaks) ---------------------
-                        
-                    if question.get("img_url"):
-                        st.image(question.get("img_url")) # แสดงรูป
-                else:
-                    st.caption("...(ไม่มีข้อมูลโจทย์)...") # กรณีดึงโจทย์ข้อนี้ไม่สำเร็จ
-
-            # 3.2) สร้างตัวเลือก (st.radio) แบบไดนามิก
-            
-            # สร้าง "ตัวเลือก" ที่จะแสดงผล
-            # (เราจะใช้ format_func เพื่อสร้างข้อความที่แสดง)
-            radio_options_values = [""] + radio_value_keys # ["", "A", "B", "C", "D", "E"]
-            
-            # สร้าง Dictionary สำหรับ map ค่า (A) ไปเป็นข้อความ (Choice A Text)
-            # ถ้าไม่มีข้อมูล question ให้ใช้ค่าว่าง
-            choice_map = {
-                "A": question.get("choice_a", "") if question else "",
-                "B": question.get("choice_b", "") if question else "",
-                "C": question.get("choice_c", "") if question else "",
-                "D": question.get("choice_d", "") if question else "",
-                "E": question.get("choice_e", "") if question else "",
-            }
-            
-            # สร้างฟังก์ชันสำหรับจัดรูปแบบการแสดงผล
-            def format_radio_option(value_key):
-                if value_key == "":
-                    return " (เว้นว่าง) "
-                
-                # ดึงข้อความของตัวเลือกจาก choice_map
-                choice_text = choice_map.get(value_key)
-                
-                if choice_text:
-                    # ถ้ามีข้อความ: แสดง "A. [ข้อความตัวเลือก]"
-                    # --------------------- ⭐️ START FIX (Line Breaks in Choices) ---------------------
-                    # เรา replace \n ด้วย " " (เว้นวรรค) ในตัวเลือก
-                    # เพราะ st.radio "ไม่รองรับ" การขึ้นบรรทัดใหม่ใน Label
-                    choice_text_single_line = choice_text.replace("\n", " ")
-                    return f" {value_key}. {choice_text_single_line} "
-                    # --------------------- ⭐️ END FIX (Line Breaks in Choices) ---------------------
-                else:
-                    # ถ้าไม่มีข้อความ (อาจารย์ไม่ได้กรอก): แสดง "A"
-                    return f" {value_key} "
-
-            current = ss["answers"][i]
-            choice = st.radio(
-                f"**คำตอบ** ข้อ {q_num}",
-                options=radio_options_values,   # ค่าที่จะถูกเก็บ: ["", "A", "B", ...]
-                format_func=format_radio_option, # ฟังก์ชันที่เปลี่ยนค่าเป็นข้อความ
-                index=radio_options_values.index(current) if current in radio_options_values else 0,
-                horizontal=True,
-                disabled=disabled_all,
-                key=f"q_{i+1}_radio_form",
-            )
-            ss["answers"][i] = choice
-            st.divider()
-        # --------------------- ⭐️ END MODIFIED LOOP ---------------------
-
-        submitted_form = st.form_submit_button(
-            "ส่งคำตอบ",
-            type="primary",
-            use_container_width=True,
-            disabled=disabled_all,
-        )
+    if len(ss["answers"]) != qn:
+        ss["answers"] = [""] * qn
 
-    if submitted_form and not ss["submitted"]:
-        if not name.strip():
-            ss["submit_error"] = "กรุณากรอกชื่อ"
-        else:
-            ss["submit_error"] = None
-            ss["pending_submit_payload"] = {
-                "exam_id": exam_id,
-                "student_name": name.strip(),
-                "answers": ss["answers"],
-            }
+    render_answer_sheet(exam_id, qn, questions_dict, disabled_all)
 
     if ss["pending_submit_payload"] is not None:
+        payload = ss["pending_submit_payload"]
+        sub_index = get_submission_index()
         with st.spinner("กำลังส่งคำตอบ..."):
             try:
-                js2 = gas_post("submit", ss["pending_submit_payload"])
+                # ตรวจซ้ำในเครื่องก่อน — ถ้าชื่อนี้ส่งไปแล้วไม่ต้องเสีย round trip ไป GAS
+                # (ยัง seed ไม่เสร็จ = ไม่พบ → ส่งไป GAS ตามปกติ ไม่รอ)
+                sub_index.ensure_seeded(payload["exam_id"])
+                if sub_index.contains(payload["exam_id"], payload["student_name"]):
+                    js2 = {"ok": False, "error": "DUPLICATE_SUBMISSION"}
+                else:
+                    js2 = gas_post("submit", payload)
                 if js2.get("ok"):
+                    sub_index.add(payload["exam_id"], payload["student_name"])
+                    discard_checkpoint(payload["exam_id"], ss["resume_token"])
                     ss["submit_result"] = js2["data"]
                     ss["submitted"] = True
                     ss["submit_error"] = None
                 else:
                     err = js2.get("error") or "ส่งคำตอบไม่สำเร็จ"
+                    if err == "DUPLICATE_SUBMISSION":
+                        sub_index.add(payload["exam_id"], payload["student_name"])
+                        discard_checkpoint(payload["exam_id"], ss["resume_token"])
                     ss["submit_error"] = err
                     ss["submitted"] = (err == "DUPLICATE_SUBMISSION")
             except Exception as e:
@@ -436,6 +901,92 @@ def page_exam():
             st.dataframe(df, hide_index=True, use_container_width=True)
 
 # ====================== Teacher Dashboard ======================
+RESULT_COLUMNS = {
+    "timestamp": "เวลา",
+    "student_name": "ชื่อ",
+    "score": "คะแนน",
+    "percent": "เปอร์เซ็นต์",
+    "answers": "คำตอบ",
+}
+PAGE_SIZES = [25, 50, 100, 200]
+
+def results_fingerprint(df: pd.DataFrame) -> str:
+    """hash ของเนื้อหาทุกคอลัมน์ที่ส่งออก — แก้คะแนน/ชื่อ/ตรวจใหม่โดยไม่เพิ่มแถวก็ได้ค่าใหม่
+    (เรียกเฉพาะหลังกด "เตรียมไฟล์" จึงไม่เสียเวลาทุก rerun)"""
+    cols = [c for c in RESULT_COLUMNS if c in df.columns]
+    content = int(pd.util.hash_pandas_object(df[cols], index=False).sum()) if len(df) else 0
+    return f"{len(df)}:{content}"
+
+@st.cache_data(max_entries=8, ttl=TTL_DASHBOARD, show_spinner=False)
+def results_csv_bytes(exam_id: str, fingerprint: str, _df: pd.DataFrame) -> bytes:
+    # _df ไม่ถูก hash (ขึ้นต้นด้วย _) — cache แยกตาม exam_id + fingerprint เท่านั้น
+    cols = [c for c in RESULT_COLUMNS if c in _df.columns]
+    return _df[cols].rename(columns=RESULT_COLUMNS).to_csv(index=False).encode("utf-8-sig")
+
+def _reset_results_page(exam_id: str):
+    st.session_state[f"results_page_{exam_id}"] = 1
+
+def paginate_results(df: pd.DataFrame, query: str, sort_col: str, ascending: bool,
+                     page: int, page_size: int) -> tuple[pd.DataFrame, int, int]:
+    """กรองตามชื่อ + เรียงลำดับ แล้วตัดเฉพาะหน้าที่ต้องการ — คืน (page_df, จำนวนแถวหลังกรอง, จำนวนหน้า)"""
+    view = df
+    query = (query or "").strip()
+    if query and "student_name" in view.columns:
+        mask = view["student_name"].astype(str).str.contains(query, case=False, regex=False, na=False)
+        view = view[mask]
+    if sort_col in view.columns:
+        view = view.sort_values(sort_col, ascending=ascending, kind="stable", na_position="last")
+    total_rows = len(view)
+    total_pages = max(1, -(-total_rows // page_size))
+    page = min(max(1, page), total_pages)
+    start = (page - 1) * page_size
+    return view.iloc[start:start + page_size], total_rows, total_pages
+
+def render_results_table(df: pd.DataFrame, exam_id: str):
+    cols = [c for c in RESULT_COLUMNS if c in df.columns]
+
+    c_search, c_sort, c_order, c_size = st.columns([3, 2, 1, 1])
+    with c_search:
+        query = st.text_input("ค้นหาชื่อ", key=f"results_q_{exam_id}", placeholder="พิมพ์บางส่วนของชื่อ",
+                              on_change=_reset_results_page, args=(exam_id,))
+    with c_sort:
+        sort_col = st.selectbox("เรียงตาม", options=cols, format_func=lambda c: RESULT_COLUMNS[c],
+                                key=f"results_sort_{exam_id}")
+    with c_order:
+        ascending = st.radio("ลำดับ", options=[True, False], format_func=lambda a: "น้อย→มาก" if a else "มาก→น้อย",
+                             key=f"results_asc_{exam_id}")
+    with c_size:
+        page_size = st.selectbox("แถว/หน้า", options=PAGE_SIZES, key=f"results_size_{exam_id}",
+                                 on_change=_reset_results_page, args=(exam_id,))
+
+    # ค้นหาก่อนเพื่อรู้จำนวนหน้า แล้วค่อยตัดหน้าตามที่เลือก
+    _, total_rows, total_pages = paginate_results(df, query, sort_col, ascending, 1, page_size)
+    page_key = f"results_page_{exam_id}"
+    if st.session_state.get(page_key, 1) > total_pages:
+        st.session_state[page_key] = total_pages  # ข้อมูลลดลงหลังรีเฟรช — อย่าให้เกิน max_value
+    page = st.number_input(f"หน้า (ทั้งหมด {total_pages})", min_value=1, max_value=total_pages, step=1,
+                           key=page_key)
+    page_df, _, _ = paginate_results(df, query, sort_col, ascending, int(page), page_size)
+
+    show = page_df[cols].rename(columns=RESULT_COLUMNS)
+    st.dataframe(show, hide_index=True, use_container_width=True)
+    st.caption(f"แสดง {len(show)} จาก {total_rows} แถว (ทั้งหมด {len(df)} คน)")
+
+    # ดาวน์โหลดข้อมูลทั้งหมด — สร้าง CSV เมื่ออาจารย์กด "เตรียมไฟล์" เท่านั้น และ cache ตามชุด/ข้อมูล
+    ready_key = f"results_csv_ready_{exam_id}"
+    if not st.session_state.get(ready_key):
+        st.button("📄 เตรียมไฟล์ CSV ผลทั้งหมด", use_container_width=True, key=f"results_csv_prepare_{exam_id}",
+                  on_click=lambda: st.session_state.update({ready_key: True}))
+    else:
+        st.download_button(
+            "⬇️ ดาวน์โหลดผลทั้งหมด (CSV)",
+            data=results_csv_bytes(exam_id, results_fingerprint(df), df),
+            file_name=f"results_{exam_id}.csv",
+            mime="text/csv",
+            use_container_width=True,
+            key=f"results_csv_{exam_id}",
+        )
+
 def page_dashboard():
     st.markdown("### 👩‍🏫 Dashboard อาจารย์ — ตั้งค่า Active Exam และดูผล")
     if not TEACHER_KEY:
@@ -452,7 +1003,7 @@ def page_dashboard():
 
         # โหลด Config/Exams
         try:
-            cfg = gas_get("get_config")
+            cfg = gas_get_cached("get_config", ttl=TTL_CONFIG)
             if not cfg.get("ok"):
                 st.error(cfg.get("error", "Config error"))
                 # --------------------- START FIX/DEBUGGING ---------------------
@@ -494,6 +1045,7 @@ def page_dashboard():
                 try:
                     js = gas_post("set_active_exam", {"exam_id": chosen_id, "teacher_key": TEACHER_KEY})
                     if js.get("ok"):
+                        invalidate_shared_cache()  # ให้ทุก replica โหลด Active Exam ใหม่
                         st.success(f"ตั้งค่า Active Exam เป็น {chosen_id} เรียบร้อย")
                     elif js.get("error") == "UNAUTHORIZED":
                         st.error("ไม่ได้รับอนุญาต (ตรวจ TEACHER_KEY ในชีท Config ของ GAS)")
@@ -506,7 +1058,7 @@ def page_dashboard():
         
         st.subheader("ผลการสอบของชุดนี้")
         try:
-            jsr = gas_get("get_dashboard", {"exam_id": chosen_id})
+            jsr = gas_get_cached("get_dashboard", {"exam_id": chosen_id}, ttl=TTL_DASHBOARD)
             if not jsr.get("ok"):
                 st.error(jsr.get("error", "Unknown error"))
                 return
@@ -520,11 +1072,9 @@ def page_dashboard():
                 df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
                 df = df.sort_values("timestamp", ascending=True)
 
-            # ใช้ Expander เพื่อจัดระเบียบตารางผล
+            # ใช้ Expander เพื่อจัดระเบียบตารางผล (แบ่งหน้าฝั่ง server ส่งไปเบราว์เซอร์เฉพาะหน้าที่เห็น)
             with st.expander("📊 สรุปผลรายคน (คลิกเพื่อดูรายละเอียด)", expanded=False):
-                show = df[["timestamp", "student_name", "score", "percent", "answers"]].copy()
-                show.columns = ["เวลา", "ชื่อ", "คะแนน", "เปอร์เซ็นต์", "คำตอบ"]
-                st.dataframe(show, hide_index=True, use_container_width=True)
+                render_results_table(df, chosen_id)
             
             st.subheader("สถิติคะแนนรวม")
             avg = float(df["percent"].astype(float).mean())
@@ -597,7 +1147,7 @@ def page_dashboard():
 
             if answer_key is None:
                 try:
-                    ex = gas_get("get_active_exam")
+                    ex = gas_get_cached("get_active_exam", ttl=TTL_ACTIVE_EXAM)
                     if ex.get("ok") and str(ex["data"].get("exam_id","")) == str(chosen_id):
                         k = str(ex["data"].get("answer_key","") or "")
                         answer_key = [c.strip().upper() for c in list(k)]